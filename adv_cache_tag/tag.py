@@ -2,21 +2,33 @@
 
 import hashlib
 import logging
-import pickle
 import re
+import threading
+import time
 import zlib
 
-from urllib.parse import quote
+from fnmatch import fnmatchcase
+from urllib.parse import quote_from_bytes
 
 from django.conf import settings
 from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.template import Engine
 from django.template import base as template
 from django.utils.encoding import smart_str, force_bytes
+from django.utils.safestring import SafeData, mark_safe
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 logger = logging.getLogger("adv_cache_tag")
 
+# zstd compressors and decompressors are reused, but cannot be used by many threads at once
+_zstd_local = threading.local()
+
 
 def is_template_debug_activated():
     for template_settings in settings.TEMPLATES:
@@ -26,6 +38,22 @@ def is_template_debug_activated():
     return False
 
 
+def hash_vary_on(vary_on, hasher=None):
+    """
+    Return the hexadecimal hash of the given arguments (the ones passed to the
+    templatetag after the fragment name), to be used in the cache key.
+    `hasher` is a callable returning a new `hashlib` hash object. If not set,
+    BLAKE2b with a 16 bytes digest is used. On systems where only FIPS approved
+    algorithms are allowed, `hashlib.sha256` can be passed instead.
+    """
+    args = hasher() if hasher else hashlib.blake2b(digest_size=16)
+    for index, var in enumerate(vary_on):
+        if index:
+            args.update(b":")
+        args.update(quote_from_bytes(force_bytes(var)).encode())
+    return args.hexdigest()
+
+
 class Node(template.Node):
     """
     It's a normal template Node, with parameters defined in __init__ and rendering
@@ -44,6 +72,10 @@ class Node(template.Node):
 
         If the `include_pk` option is activated, the first argument in `vary_on`
         will be used as the `pk` (but not removed from `vary_on`.
+
+        If `vary_on` ends with `if something` or `unless something`, these two
+        arguments are popped and `something` is used to decide, at render time,
+        if the cache is used or not.
         """
         super(Node, self).__init__()
         self.nodename = nodename
@@ -51,6 +83,13 @@ class Node(template.Node):
         self.expire_time = template.Variable(expire_time)
         self.fragment_name = template.Variable(fragment_name)
 
+        self.condition = None
+        self.condition_negated = False
+        if len(vary_on) >= 2 and vary_on[-2] in ("if", "unless"):
+            self.condition_negated = vary_on[-2] == "unless"
+            self.condition = template.Variable(vary_on[-1])
+            del vary_on[-2:]
+
         self.cache_backend = None
         if vary_on and vary_on[-1].startswith("using="):
             self.cache_backend = vary_on.pop()[len("using=") :]
@@ -96,11 +135,14 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         * ADV_CACHE_VERSIONING
         * ADV_CACHE_COMPRESS
         * ADV_CACHE_COMPRESS_LEVEL
+        * ADV_CACHE_COMPRESS_BACKEND
+        * ADV_CACHE_COMPRESS_MIN_BYTES
         * ADV_CACHE_COMPRESS_SPACES
         * ADV_CACHE_INCLUDE_PK
         * ADV_CACHE_BACKEND
         * ADV_CACHE_VERSION
         * ADV_CACHE_RESOLVE_NAME
+        * ADV_CACHE_TAGS
 
     Or inherit from this class and don't forget to register your tag :
 
@@ -115,12 +157,25 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
     """
 
     # Will change if the algorithm changes
-    INTERNAL_VERSION = "1"
+    INTERNAL_VERSION = "2"
     # Used to separate internal version, template version, and the content
     VERSION_SEPARATOR = "::"
 
-    # Regex used to reduce spaces/blanks (many spaces into one)
-    RE_SPACELESS = re.compile(r"\s\s+")
+    # Prefix of the encoded content, telling if the html was marked as safe or not,
+    # and if it was compressed (upper case) or left as is because too small (lower case)
+    SAFE_CONTENT_FLAG = b"S"
+    PLAIN_CONTENT_FLAG = b"P"
+    SAFE_RAW_CONTENT_FLAG = b"s"
+    PLAIN_RAW_CONTENT_FLAG = b"p"
+
+    # Compression level used by the "zstd" compress backend when `compress_level`
+    # is `None` (the default level of the library)
+    ZSTD_DEFAULT_COMPRESSION = 3
+
+    # Regex used to reduce spaces/blanks (many spaces into one), applied on the
+    # utf-8 encoded html, so only ascii blanks are reduced (a str pattern, as in
+    # previous versions, is applied on the html as is)
+    RE_SPACELESS = re.compile(rb"\s\s+")
 
     # generate a token for this site, based on the secret_key
     RAW_TOKEN = (
@@ -157,7 +212,12 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
 
         # If the content will be compressed before caching
         compress = getattr(settings, "ADV_CACHE_COMPRESS", False)
-        compress_level = getattr(settings, "ADV_CACHE_COMPRESS_LEVEL", zlib.Z_DEFAULT_COMPRESSION)
+        # Levels 1 to 3 are usually the best speed/ratio compromise for html fragments
+        compress_level = getattr(settings, "ADV_CACHE_COMPRESS_LEVEL", 1)
+        # The library used to compress: "zlib" or "zstd" (needs the `zstandard` package)
+        compress_backend = getattr(settings, "ADV_CACHE_COMPRESS_BACKEND", "zlib")
+        # Smaller contents (in bytes) are not compressed: it would cost cpu for no gain
+        compress_min_bytes = getattr(settings, "ADV_CACHE_COMPRESS_MIN_BYTES", 50)
 
         # If many spaces/blanks will be converted into one
         compress_spaces = getattr(settings, "ADV_CACHE_COMPRESS_SPACES", False)
@@ -174,6 +234,9 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         # If the fragment name should be resolved or taken as is
         resolve_fragment = getattr(settings, "ADV_CACHE_RESOLVE_NAME", False)
 
+        # Patterns of cache keys that can be invalidated all at once (see `invalidate_tag`)
+        tags = getattr(settings, "ADV_CACHE_TAGS", ())
+
     # Use a metaclass to use the right class in the Node class, and assign Meta to options
 
     def __init__(self, node, context):
@@ -204,22 +267,51 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
 
         # Final "INTERNAL_VERSION"
         if self.options.internal_version:
-            self.INTERNAL_VERSION = force_bytes(
-                "%s|%s" % (self.__class__.INTERNAL_VERSION, self.options.internal_version)
+            self.INTERNAL_VERSION = b"%s|%s" % (
+                force_bytes(self.__class__.INTERNAL_VERSION),
+                force_bytes(self.options.internal_version),
             )
         else:
             self.INTERNAL_VERSION = force_bytes(self.__class__.INTERNAL_VERSION)
 
         self.VERSION_SEPARATOR = force_bytes(self.__class__.VERSION_SEPARATOR)
 
-        # prepare all parameters passed to the templatetag
+        # indicate if the cache is used, depending on the `if`/`unless` condition
+        self.use_cache = self.check_condition()
+
+        # prepare all parameters passed to the templatetag (even if the cache is
+        # not used, to always validate them)
         self.expire_time = None
         self.version = None
         self.prepare_params()
 
-        # get the cache and cache key
-        self.cache = self.get_cache_object()
-        self.cache_key = self.get_cache_key()
+        self.cache = None
+        self.cache_key = None
+        self.tags = []
+        if self.use_cache:
+            # get the cache and cache key
+            self.cache = self.get_cache_object()
+            self.cache_key = self.get_cache_key()
+
+            # the generations of the matching tags are part of the internal version
+            self.tags = self.get_tags()
+            if self.tags:
+                self.add_tags_generations()
+
+    def check_condition(self):
+        """
+        Return `False` if the `if`/`unless` condition passed to the templatetag
+        says that the cache must not be used: the content will then be rendered
+        without getting or setting anything in the cache.
+        A variable that cannot be resolved is seen as a false value.
+        """
+        if self.node.condition is None:
+            return True
+        try:
+            value = self.node.condition.resolve(self.context)
+        except template.VariableDoesNotExist:
+            value = None
+        return bool(value) != self.node.condition_negated
 
     def prepare_params(self):
         """
@@ -291,9 +383,7 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         Take all the arguments passed after the fragment name and return a
         hashed version which will be used in the cache key
         """
-        return hashlib.md5(
-            force_bytes(":".join([quote(force_bytes(var)) for var in self.vary_on]))
-        ).hexdigest()
+        return hash_vary_on(self.vary_on)
 
     def get_pk(self):
         """
@@ -347,6 +437,72 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         """
         return caches[self.node.cache_backend or self.options.cache_backend]
 
+    def get_tags(self):
+        """
+        Return the tags (from the `tags` option) matching the cache key. A tag
+        is a pattern of cache keys, `fnmatch` style, like
+        "template.cache.my_fragment.*".
+        """
+        return [tag for tag in self.options.tags if fnmatchcase(self.cache_key, tag)]
+
+    @staticmethod
+    def get_tag_cache_key(tag):
+        """
+        Return the cache key used to store the generation of the given tag
+        """
+        return "template.tag.%s" % hash_vary_on([tag])
+
+    @staticmethod
+    def get_new_tag_generation():
+        """
+        Return the generation to use for a tag not having one in the cache
+        (never invalidated, or lost by the cache). It's a timestamp, so that
+        contents cached with a lost generation cannot become valid again.
+        """
+        return time.time_ns()
+
+    def add_tags_generations(self):
+        """
+        Get the current generation of each tag matching the cache key and add
+        them to the internal version, so an invalidated tag makes the cached
+        content outdated. If it fails, the cache is not used.
+        """
+        keys = [self.get_tag_cache_key(tag) for tag in self.tags]
+        try:
+            generations = self.cache.get_many(keys)
+            for key in keys:
+                if key not in generations:
+                    generation = self.get_new_tag_generation()
+                    # another process may have set it in the meantime
+                    if not self.cache.add(key, generation, None):
+                        generation = self.cache.get(key, generation)
+                    generations[key] = generation
+        except Exception:
+            if is_template_debug_activated():
+                raise
+            logger.exception("Error when getting the generations of the cache tags")
+            self.use_cache = False
+            return
+        self.INTERNAL_VERSION += b"|" + b",".join(b"%d" % generations[key] for key in keys)
+
+    @classmethod
+    def invalidate_tag(cls, tag, cache_backend=None):
+        """
+        Invalidate all the cached templates having a key matching the given
+        tag, which must be in the `tags` option, by incrementing its
+        generation. The outdated contents are regenerated on their next
+        rendering, without having to find and delete them.
+        """
+        if tag not in cls.options.tags:
+            raise ValueError("The tag %r is not in the `tags` option" % tag)
+        cache = caches[cache_backend or cls.options.cache_backend]
+        key = cls.get_tag_cache_key(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # no generation in the cache, a new one is enough to invalidate
+            cache.add(key, cls.get_new_tag_generation(), None)
+
     def cache_get(self):
         """
         Get content from the cache
@@ -369,7 +525,8 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         """
         parts = [self.INTERNAL_VERSION]
         if self.options.versioning:
-            parts.append(force_bytes(self.version))
+            # already converted to bytes in `prepare_params`
+            parts.append(self.version)
         parts.append(force_bytes(to_cache))
 
         return self.VERSION_SEPARATOR.join(parts)
@@ -384,33 +541,109 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
         the versions didn't match, to save some cpu cycles.
         """
         try:
-            nb_parts = 2
-            if self.options.versioning:
-                nb_parts = 3
+            # Use `find` and slices instead of `split` to not build a list of parts
+            content, separator = self.content, self.VERSION_SEPARATOR
 
-            parts = self.content.split(self.VERSION_SEPARATOR, nb_parts - 1)
-            assert len(parts) == nb_parts
+            end = content.find(separator)
+            assert end != -1
+            self.content_internal_version = content[:end]
+            start = end + len(separator)
 
-            self.content_internal_version = parts[0]
             if self.options.versioning:
-                self.content_version = parts[1]
+                end = content.find(separator, start)
+                assert end != -1
+                self.content_version = content[start:end]
+                start = end + len(separator)
 
-            self.content = parts[-1]
+            self.content = content[start:]
         except Exception:
             self.content = None
 
+    def compress(self, data):
+        """
+        Compress the given bytes, using the library defined by the
+        `compress_backend` option
+        """
+        level = self.options.compress_level
+        if self.options.compress_backend == "zstd":
+            if zstandard is None:
+                raise ImproperlyConfigured(
+                    'The "zstd" compress backend needs the `zstandard` package'
+                )
+            if level is None:
+                level = self.ZSTD_DEFAULT_COMPRESSION
+            return self.get_zstd_compressor(level).compress(data)
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        return zlib.compress(data, level)
+
+    def decompress(self, data):
+        """
+        Decompress the given bytes, using the library defined by the
+        `compress_backend` option
+        """
+        if self.options.compress_backend == "zstd":
+            if zstandard is None:
+                raise ImproperlyConfigured(
+                    'The "zstd" compress backend needs the `zstandard` package'
+                )
+            return self.get_zstd_decompressor().decompress(data)
+        return zlib.decompress(data)
+
+    @staticmethod
+    def get_zstd_compressor(level):
+        """
+        Return a zstd compressor for the given level, created once per thread
+        """
+        compressors = getattr(_zstd_local, "compressors", None)
+        if compressors is None:
+            compressors = _zstd_local.compressors = {}
+        compressor = compressors.get(level)
+        if compressor is None:
+            compressor = compressors[level] = zstandard.ZstdCompressor(level=level)
+        return compressor
+
+    @staticmethod
+    def get_zstd_decompressor():
+        """
+        Return a zstd decompressor, created once per thread
+        """
+        decompressor = getattr(_zstd_local, "decompressor", None)
+        if decompressor is None:
+            decompressor = _zstd_local.decompressor = zstandard.ZstdDecompressor()
+        return decompressor
+
     def decode_content(self):
         """
         Decode (decompress...) the content got from the cache, to the final
         html
         """
-        self.content = pickle.loads(zlib.decompress(self.content))
+        flag = self.content[:1]
+        if flag in (self.SAFE_CONTENT_FLAG, self.PLAIN_CONTENT_FLAG):
+            html = self.decompress(memoryview(self.content)[1:])
+        elif flag in (self.SAFE_RAW_CONTENT_FLAG, self.PLAIN_RAW_CONTENT_FLAG):
+            html = self.content[1:]
+        else:
+            raise ValueError("Invalid flag in the cached content: %r" % flag)
+        html = html.decode("utf-8")
+        if flag in (self.SAFE_CONTENT_FLAG, self.SAFE_RAW_CONTENT_FLAG):
+            html = mark_safe(html)
+        self.content = html
 
     def encode_content(self):
         """
-        Encode (compress...) the html to the data to be cached
+        Encode (compress...) the html to the data to be cached. The utf-8 html,
+        compressed if not smaller than the `compress_min_bytes` option, is
+        prefixed by a flag telling if it was compressed and marked as safe.
         """
-        return zlib.compress(pickle.dumps(self.content), self.options.compress_level)
+        is_safe = isinstance(self.content, SafeData)
+        # the content is already encoded if the "compress_spaces" option is on
+        data = force_bytes(self.content)
+        if len(data) < self.options.compress_min_bytes:
+            flag = self.SAFE_RAW_CONTENT_FLAG if is_safe else self.PLAIN_RAW_CONTENT_FLAG
+            return flag + data
+        flag = self.SAFE_CONTENT_FLAG if is_safe else self.PLAIN_CONTENT_FLAG
+        return flag + self.compress(data)
 
     def render_node(self):
         """
@@ -420,12 +653,19 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
 
     def create_content(self):
         """
-        Render the template, apply options on it, and save it to the cache.
+        Render the template, apply options on it, and save it to the cache
+        (if the cache is used).
         """
         self.render_node()
 
         if self.options.compress_spaces:
-            self.content = self.RE_SPACELESS.sub(" ", self.content)
+            if isinstance(self.RE_SPACELESS.pattern, str):
+                self.content = self.RE_SPACELESS.sub(" ", self.content)
+            else:
+                self.content = self.RE_SPACELESS.sub(b" ", self.content.encode("utf-8"))
+
+        if not self.use_cache:
+            return
 
         if self.options.compress:
             to_cache = self.encode_content()
@@ -453,7 +693,7 @@ class CacheTag(object, metaclass=CacheTagMetaClass):
 
         self.content = None
 
-        if not self.regenerate:
+        if self.use_cache and not self.regenerate:
             try:
                 self.content = self.cache_get()
             except Exception:
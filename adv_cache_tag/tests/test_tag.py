@@ -1,63 +1,177 @@
 import hashlib
-import pickle
 import pytest
+import re
 import time
 import zlib
 
-from copy import deepcopy
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
-from urllib.parse import quote
+from functools import lru_cache
+from textwrap import dedent
 
 from django.conf import settings
 from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.cache.utils import make_template_fragment_key
+from django.template import Engine
 from django.template import base as template
 from django.template.context import Context
 from django.test import override_settings
 from django.utils.encoding import force_bytes
-from django.utils.safestring import SafeText
 
-from adv_cache_tag.tag import CacheTag
+from adv_cache_tag.tag import CacheTag, hash_vary_on, is_template_debug_activated, zstandard
+
+# Compress backends to test, "zstd" only if its library is installed
+COMPRESS_BACKENDS = [
+    "zlib",
+    pytest.param(
+        "zstd",
+        marks=pytest.mark.skipif(zstandard is None, reason="`zstandard` is not installed"),
+    ),
+]
+
+# ``(RAW_TOKEN, RAW_TOKEN_START, RAW_TOKEN_END)`` computed for each ``SECRET_KEY``
+_RAW_TOKEN_CACHE = {}
+
+# ``SECRET_KEY`` for which the RAW tokens were last set on ``CacheTag``
+_LAST_SECRET = None
+
+# Salted hashers used to compute the RAW tokens, to be copied before use
+_SHA1_SALT1 = hashlib.sha1(b"RAW_TOKEN_SALT1")
+_SHA1_SALT2 = hashlib.sha1(b"RAW_TOKEN_SALT2")
+
+# Templates used in many tests, or rendered many times in their tests
+_T_ADV_CACHE = dedent(
+    """
+    {% load adv_cache %}
+    {% cache 1 test_cached_template obj.pk obj.updated_at %}
+        {{ obj.get_name }}
+    {% endcache %}
+    """
+).strip()
+
+_T_NOCACHE_LIBS = dedent(
+    """
+    {% load adv_cache other_tags %}
+    {% cache 1 test_cached_template obj.pk obj.updated_at %}
+        {{ obj.get_name }} {% insert_foo %}
+        {% nocache %}
+            {% load other_filters %}
+            {{ obj.get_foo|double_upper }} {% insert_foo %}
+        {% endnocache %}
+        !!
+    {% endcache %}
+    """
+).strip()
+
+_T_CACHE_SET_FAIL = dedent(
+    """
+    {% load adv_cache_test %}
+    {% cache_set_fail 1 test_cached_template obj.pk obj.updated_at %}
+        {{ obj.get_name }}
+    {% endcache_set_fail %}
+    """
+).strip()
+
+_T_CACHE_GET_FAIL = dedent(
+    """
+    {% load adv_cache_test %}
+    {% cache_get_fail 1 test_cached_template obj.pk obj.updated_at %}
+        {{ obj.get_name }}
+    {% endcache_get_fail %}
+    """
+).strip()
+
+
+@lru_cache(maxsize=None)
+def compress_encoded(encoded, level, compress_backend):
+    """Return the compressed version of an utf-8 html, as expected in the cache."""
+    if compress_backend == "zstd":
+        if level is None:
+            level = CacheTag.ZSTD_DEFAULT_COMPRESSION
+        return zstandard.ZstdCompressor(level=level).compress(encoded)
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    return zlib.compress(encoded, level)
+
+
+@lru_cache(maxsize=4096)
+def compute_template_key(fragment_name, vary_on, prefix):
+    """Compose the cache key of a template, ``vary_on`` being a tuple."""
+    return (prefix + ".%s.%s") % (fragment_name, hash_vary_on(vary_on))
+
+
+def fast_clear(cache):
+    """Clear a cache, emptying directly the storage of local memory ones, without locking."""
+    if isinstance(cache, LocMemCache):
+        cache._cache.clear()
+        cache._expire_info.clear()
+    else:
+        cache.clear()
 
 
 class TestTag:
     """First basic test case to be able to test python/django compatibility."""
 
+    # Compiled templates, by template text
+    _compiled_cache = {}
+
     @classmethod
     def reload_config(cls):
         """Resest the ``CacheTag`` configuration from current settings"""
         CacheTag.options.versioning = getattr(settings, "ADV_CACHE_VERSIONING", False)
         CacheTag.options.compress = getattr(settings, "ADV_CACHE_COMPRESS", False)
         CacheTag.options.compress_level = getattr(settings, "ADV_CACHE_COMPRESS_LEVEL", False)
+        CacheTag.options.compress_backend = getattr(settings, "ADV_CACHE_COMPRESS_BACKEND", "zlib")
+        CacheTag.options.compress_min_bytes = getattr(settings, "ADV_CACHE_COMPRESS_MIN_BYTES", 50)
         CacheTag.options.compress_spaces = getattr(settings, "ADV_CACHE_COMPRESS_SPACES", False)
         CacheTag.options.include_pk = getattr(settings, "ADV_CACHE_INCLUDE_PK", False)
         CacheTag.options.cache_backend = getattr(settings, "ADV_CACHE_BACKEND", "default")
         CacheTag.options.resolve_fragment = getattr(settings, "ADV_CACHE_RESOLVE_NAME", False)
+        CacheTag.options.tags = getattr(settings, "ADV_CACHE_TAGS", ())
+
+        # Some options are used when parsing, so compiled templates may be outdated
+        cls._compiled_cache.clear()
+
+        # Nothing to do if the tokens were already set for the current secret key
+        global _LAST_SECRET
+        secret_key = settings.SECRET_KEY
+        if secret_key == _LAST_SECRET and CacheTag.RAW_TOKEN:
+            return
+
+        # The tokens only depend on the secret key, so compute them once per secret key
+        if secret_key not in _RAW_TOKEN_CACHE:
+            # generate a token for this site, based on the secret_key
+            inner = _SHA1_SALT2.copy()
+            inner.update(force_bytes(secret_key))
+            outer = _SHA1_SALT1.copy()
+            outer.update(force_bytes(inner.hexdigest()))
+            raw_token = "RAW_" + outer.hexdigest()
+            _RAW_TOKEN_CACHE[secret_key] = (
+                raw_token,
+                # tokens to use around the already parsed parts of the cached template
+                template.BLOCK_TAG_START + raw_token + template.BLOCK_TAG_END,
+                template.BLOCK_TAG_START + "end" + raw_token + template.BLOCK_TAG_END,
+            )
+
+        (
+            CacheTag.RAW_TOKEN,
+            CacheTag.RAW_TOKEN_START,
+            CacheTag.RAW_TOKEN_END,
+        ) = _RAW_TOKEN_CACHE[secret_key]
+        _LAST_SECRET = secret_key
 
-        # generate a token for this site, based on the secret_key
-        CacheTag.RAW_TOKEN = (
-            "RAW_"
-            + hashlib.sha1(
-                b"RAW_TOKEN_SALT1"
-                + force_bytes(
-                    hashlib.sha1(b"RAW_TOKEN_SALT2" + force_bytes(settings.SECRET_KEY)).hexdigest()
-                )
-            ).hexdigest()
-        )
-
-        # tokens to use around the already parsed parts of the cached template
-        CacheTag.RAW_TOKEN_START = (
-            template.BLOCK_TAG_START + CacheTag.RAW_TOKEN + template.BLOCK_TAG_END
-        )
-        CacheTag.RAW_TOKEN_END = (
-            template.BLOCK_TAG_START + "end" + CacheTag.RAW_TOKEN + template.BLOCK_TAG_END
-        )
+    @classmethod
+    def setup_class(cls):
+        """Get the cache backends once for all the tests."""
+        cls._all_caches = [caches[cache_name] for cache_name in settings.CACHES]
 
     def setup_method(self):
         """Clean stuff and create an object to use in templates, and some counters."""
         # Clear the cache
-        for cache_name in settings.CACHES:
-            caches[cache_name].clear()
+        for cache in self._all_caches:
+            fast_clear(cache)
 
         # Reset CacheTag config with default value (from the ``override_settings``)
         self.reload_config()
@@ -71,25 +185,42 @@ class TestTag:
             "updated_at": datetime(2015, 10, 27, 0, 0, 0),
         }
 
-        # To count the number of calls of ``get_name`` and ``get_foo``.
-        self.get_name_called = 0
-        self.get_foo_called = 0
+        # To count the number of calls of ``get_name`` (index 0) and ``get_foo`` (index 1).
+        self._calls = array("i", [0, 0])
+
+    @property
+    def get_name_called(self):
+        """Number of calls of ``get_name``."""
+        return self._calls[0]
+
+    @get_name_called.setter
+    def get_name_called(self, value):
+        self._calls[0] = value
+
+    @property
+    def get_foo_called(self):
+        """Number of calls of ``get_foo``."""
+        return self._calls[1]
+
+    @get_foo_called.setter
+    def get_foo_called(self, value):
+        self._calls[1] = value
 
     def get_name(self):
         """Called in template when asking for ``obj.get_name``."""
-        self.get_name_called += 1
+        self._calls[0] += 1
         return self.obj["name"]
 
     def get_foo(self):
         """Called in template when asking for ``obj.get_foo``."""
-        self.get_foo_called += 1
-        return "foo %d" % self.get_foo_called
+        self._calls[1] += 1
+        return "foo %d" % self._calls[1]
 
     def teardown_method(self):
         """Clear caches at the end."""
 
-        for cache_name in settings.CACHES:
-            caches[cache_name].clear()
+        for cache in self._all_caches:
+            fast_clear(cache)
 
     @classmethod
     def teardown_class(cls):
@@ -101,18 +232,22 @@ class TestTag:
     @staticmethod
     def get_template_key(fragment_name, vary_on=None, prefix="template.cache"):
         """Compose the cache key of a template."""
-        if vary_on is None:
-            vary_on = ()
-        key = ":".join([quote(force_bytes(var)) for var in vary_on])
-        args = hashlib.md5(force_bytes(key))
-        return (prefix + ".%s.%s") % (fragment_name, args.hexdigest())
+        vary_on = tuple(vary_on or ())
+        try:
+            return compute_template_key(fragment_name, vary_on, prefix)
+        except TypeError:
+            # unhashable arguments, cannot be memoized
+            return compute_template_key.__wrapped__(fragment_name, vary_on, prefix)
 
     def render(self, template_text, extend_context_dict=None):
-        """Utils to render a template text with a context given as a dict."""
+        """Utils to render a template text with a context given as a dict, stripped."""
         context_dict = {"obj": self.obj}
         if extend_context_dict:
             context_dict.update(extend_context_dict)
-        return template.Template(template_text).render(Context(context_dict))
+        compiled = self._compiled_cache.get(template_text)
+        if compiled is None:
+            compiled = self._compiled_cache[template_text] = template.Template(template_text)
+        return compiled.render(Context(context_dict)).strip()
 
     def test_default_cache(self):
         """This test is only to validate the testing procedure."""
@@ -127,7 +262,7 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
@@ -139,7 +274,7 @@ class TestTag:
         assert caches["default"].get(key).strip() == expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
 
     def test_adv_cache(self):
@@ -147,70 +282,56 @@ class TestTag:
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # But it should NOT be the exact content as adv_cache_tag adds a version
         assert caches["default"].get(key).strip() != expected
 
         # It should be the version from `adv_cache_tag`
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n    foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
-    def test_timeout_value(self):
-        "Test that timeout value is ``None`` or an integer." ""
-
-        ok_values = ("0", "1", "9999", '"0"', '"1"', '"9999"', "None")
-        ko_values = ("-1", "-9999", '"-1"', '"-9999"', '"foo"', '""', "12.3", '"12.3"')
-
-        t = """
-            {%% load adv_cache %%}
-            {%% cache %s test_cached_template obj.pk obj.updated_at %%}
-                {{ obj.get_name }}
-            {%% endcache %%}
-        """
+    TIMEOUT_TEMPLATE = """
+        {%% load adv_cache %%}
+        {%% cache %s test_cached_template obj.pk obj.updated_at %%}
+            {{ obj.get_name }}
+        {%% endcache %%}
+    """
 
-        for value in ok_values:
+    @pytest.mark.parametrize("value", ("0", "1", "9999", '"0"', '"1"', '"9999"', "None"))
+    def test_timeout_value_ok(self, value):
+        """Test that timeout value can be ``None`` or an integer."""
 
-            def test_value(value):
-                self.render(t % value)
+        self.render(self.TIMEOUT_TEMPLATE % value)
 
-            if hasattr(self, "subTest"):
-                with self.subTest(value=value):
-                    test_value(value)
-            else:
-                test_value(value)
+    @pytest.mark.parametrize(
+        "value", ("-1", "-9999", '"-1"', '"-9999"', '"foo"', '""', "12.3", '"12.3"')
+    )
+    def test_timeout_value_ko(self, value):
+        """Test that timeout value cannot be something else than ``None`` or an integer."""
 
-        for value in ko_values:
+        with pytest.raises(template.TemplateSyntaxError) as raise_context:
+            self.render(self.TIMEOUT_TEMPLATE % value)
+        assert "tag got a non-integer (or None) timeout value" in str(raise_context)
 
-            def test_value(value):
-                with pytest.raises(template.TemplateSyntaxError) as raise_context:
-                    self.render(t % value)
-                assert "tag got a non-integer (or None) timeout value" in str(raise_context)
+    def test_hash_vary_on_hasher(self):
+        """Test that another hash algorithm can be used to hash the cache key arguments."""
 
-            if hasattr(self, "subTest"):
-                with self.subTest(value=value):
-                    test_value(value)
-            else:
-                test_value(value)
+        vary_on = [self.obj["pk"], "foo bar"]
+        assert hash_vary_on(vary_on) == "d36a88c539ec3e2f8459aeb0b0eb67d0"
+        assert hash_vary_on(vary_on, hashlib.sha256) == hashlib.sha256(b"42:foo%20bar").hexdigest()
 
     def test_quoted_fragment_name(self):
         """Test quotes behaviour around the fragment name."""
@@ -266,14 +387,14 @@ class TestTag:
             {% endcache %}
         """
         expected = "foobar foo"
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         key = self.get_template_key(
             "test_cached_template",
             vary_on=[self.obj["pk"], "foo", self.obj["updated_at"]],
         )
         # no quotes arround `test_cached_template`
-        assert key == "template.cache.test_cached_template.f2f294788f4c38512d3b544ce07befd0"
-        cache_expected = b"1::\n                foobar foo"
+        assert key == "template.cache.test_cached_template.86e26fab47a86e2c56c21e87aa9425c9"
+        cache_expected = b"2::\n                foobar foo"
         assert caches["default"].get(key).strip() == cache_expected
 
         t = """
@@ -283,14 +404,14 @@ class TestTag:
             {% endcache %}
         """
         expected = "foobar bar"
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         key = self.get_template_key(
             "test_cached_template",
             vary_on=[self.obj["pk"], "bar", self.obj["updated_at"]],
         )
         # no quotes arround `test_cached_template`
-        assert key == "template.cache.test_cached_template.8bccdefc91dc857fc02f6938bf69b816"
-        cache_expected = b"1::\n                foobar bar"
+        assert key == "template.cache.test_cached_template.ef06862e389b259f34a846709f5ed2cd"
+        cache_expected = b"2::\n                foobar bar"
         assert caches["default"].get(key).strip() == cache_expected
 
     @override_settings(
@@ -304,46 +425,136 @@ class TestTag:
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
 
         # ``obj.updated_at`` is not in the key anymore, serving as the object version
         key = self.get_template_key("test_cached_template", vary_on=[self.obj["pk"]])
-        assert key == "template.cache.test_cached_template.a1d0c6e83f027327d8461063f4ac58a6"
+        assert key == "template.cache.test_cached_template.755345b7ef54b0d592c17e04737ab3d9"
 
         # It should be in the cache, with the ``updated_at`` in the version
-        cache_expected = b"1::2015-10-27 00:00:00::\n                foobar"
+        cache_expected = b"2::2015-10-27 00:00:00::\n    foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
         # We can update the date
         self.obj["updated_at"] = datetime(2015, 10, 28, 0, 0, 0)
 
         # Render with the new date, we should miss the cache because of the new "version
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 2  # One more
 
         # It should be in the cache, with the new ``updated_at`` in the version
-        cache_expected = b"1::2015-10-28 00:00:00::\n                foobar"
+        cache_expected = b"2::2015-10-28 00:00:00::\n    foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
+        # And the old version was replaced, not kept under another key
+        assert len(caches["default"]._cache) == 1
+
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 2  # Still 2
 
+    @override_settings(
+        ADV_CACHE_TAGS=["template.cache.test_cached_template.*", "template.cache.other.*"],
+    )
+    def test_tags(self):
+        """Test invalidating all the keys matching a tag from ``ADV_CACHE_TAGS``."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        expected = "foobar"
+        tag = "template.cache.test_cached_template.*"
+        tag_key = CacheTag.get_tag_cache_key(tag)
+
+        # Render a first time, should miss the cache
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 1
+
+        # A new generation was set for the only matching tag, not reusable if it's lost
+        generation = caches["default"].get(tag_key)
+        assert generation > 1
+
+        # It should be in the cache, with this generation
+        key = self.get_template_key(
+            "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
+        )
+        cache_expected = b"2|%d::\n    foobar" % generation
+        assert caches["default"].get(key).strip() == cache_expected
+
+        # Render a second time, should hit the cache
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 1  # Still 1
+
+        # Invalidating another tag does nothing
+        CacheTag.invalidate_tag("template.cache.other.*")
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 1  # Still 1
+
+        # Invalidating an unknown tag is an error
+        with pytest.raises(ValueError):
+            CacheTag.invalidate_tag("template.cache.unknown.*")
+
+        # Invalidate the tag: the cached content is outdated, without being deleted
+        CacheTag.invalidate_tag(tag)
+        assert caches["default"].get(tag_key) == generation + 1
+        assert caches["default"].get(key).strip() == cache_expected
+
+        # Render with the new generation, we should miss the cache
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 2  # One more
+
+        # It should be in the cache, under the same key, with the new generation
+        cache_expected = b"2|%d::\n    foobar" % (generation + 1)
+        assert caches["default"].get(key).strip() == cache_expected
+
+        # Render a second time, should hit the cache
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 2  # Still 2
+
+        # If the generation is lost, a new one is used: old contents are still outdated
+        caches["default"].delete(tag_key)
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 3  # One more
+        assert caches["default"].get(tag_key) not in (generation, generation + 1)
+
+        # Same when invalidating a lost generation
+        caches["default"].delete(tag_key)
+        CacheTag.invalidate_tag(tag)
+        assert self.render(_T_ADV_CACHE) == expected
+        assert self.get_name_called == 4  # One more
+
+    @override_settings(
+        ADV_CACHE_TAGS=["template.cache.test_cached_template.*"],
+    )
+    def test_tags_failure(self, monkeypatch):
+        """Test that the cache is not used if the generations of the tags cannot be read."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        def get_many(*args, **kwargs):
+            raise ValueError("boom get_many")
+
+        monkeypatch.setattr(caches["default"], "get_many", get_many)
+
+        # Render two times, the template is rendered each time and nothing is cached
+        assert self.render(_T_ADV_CACHE) == "foobar"
+        assert self.render(_T_ADV_CACHE) == "foobar"
+        assert self.get_name_called == 2
+
+        key = self.get_template_key(
+            "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
+        )
+        assert caches["default"].get(key) is None
+
     @override_settings(
         ADV_CACHE_INCLUDE_PK=True,
     )
@@ -355,15 +566,8 @@ class TestTag:
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
@@ -373,60 +577,60 @@ class TestTag:
             "test_cached_template.%s" % self.obj["pk"],
             vary_on=[self.obj["pk"], self.obj["updated_at"]],
         )
-        assert key == "template.cache.test_cached_template.42.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.42.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n    foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
     @override_settings(
         ADV_CACHE_COMPRESS_SPACES=True,
     )
-    def test_space_compression(self):
+    # A str pattern, as in previous versions, must still work
+    @pytest.mark.parametrize("pattern", [rb"\s\s+", r"\s\s+"], ids=["bytes", "str"])
+    def test_space_compression(self, monkeypatch, pattern):
         """Test with ``ADV_CACHE_COMPRESS_SPACES`` set to ``True``."""
 
         # Reset CacheTag config with default value (from the ``override_settings``)
         self.reload_config()
+        monkeypatch.setattr(CacheTag, "RE_SPACELESS", re.compile(pattern))
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
-        # It should be in the cache, with only one space instead of many white spaces
-        cache_expected = b"1:: foobar "
+        # It should be in the cache, with only one space instead of many white spaces (the
+        # single new line at the end is kept)
+        cache_expected = b"2:: foobar\n"
         assert caches["default"].get(key) == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
     @override_settings(
         ADV_CACHE_COMPRESS=True,
+        ADV_CACHE_COMPRESS_MIN_BYTES=0,
     )
-    def test_compression(self):
+    @pytest.mark.parametrize("compress_backend", COMPRESS_BACKENDS)
+    def test_compression(self, compress_backend):
         """Test with ``ADV_CACHE_COMPRESS`` set to ``True``."""
 
         # Reset CacheTag config with default value (from the ``override_settings``)
         self.reload_config()
+        CacheTag.options.compress_backend = compress_backend
 
         expected = "foobar"
 
@@ -438,78 +642,141 @@ class TestTag:
         )
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache, compressed
-        # We use ``SafeText`` as django does in templates
-        compressed = zlib.compress(pickle.dumps(SafeText("  foobar  ")), -1)
-        cache_expected = b"1::" + compressed
+        # Flagged as safe (``S``) because django marks the rendered html as safe
+        compressed = b"S" + compress_encoded(b"  foobar  ", 1, compress_backend)
+        cache_expected = b"2::" + compressed
         assert caches["default"].get(key) == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
 
         # Changing the compression level should not invalidate the cache
         CacheTag.options.compress_level = 9
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
 
         # But if the cache is invalidated, the new one will use this new level
         caches["default"].delete(key)
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 2  # One more
-        compressed = zlib.compress(pickle.dumps(SafeText("  foobar  ")), 9)
-        cache_expected = b"1::" + compressed
+        compressed = b"S" + compress_encoded(b"  foobar  ", 9, compress_backend)
+        cache_expected = b"2::" + compressed
         assert caches["default"].get(key) == cache_expected
 
+        # ``None`` is the default level of the library, ``-1`` a real level (faster for zstd)
+        for calls, level in enumerate((None, -1), start=3):
+            CacheTag.options.compress_level = level
+            caches["default"].delete(key)
+            assert self.render(t) == expected
+            assert self.get_name_called == calls  # One more
+            compressed = b"S" + compress_encoded(b"  foobar  ", level, compress_backend)
+            assert caches["default"].get(key) == b"2::" + compressed
+
+    @pytest.mark.skipif(zstandard is None, reason="`zstandard` is not installed")
+    def test_zstd_compressors(self):
+        """Test that zstd compressors are reused, and that ``-1`` is not the default level."""
+
+        assert CacheTag.get_zstd_compressor(-1) is CacheTag.get_zstd_compressor(-1)
+        assert CacheTag.get_zstd_compressor(-1) is not CacheTag.get_zstd_compressor(3)
+        assert CacheTag.get_zstd_decompressor() is CacheTag.get_zstd_decompressor()
+
+        CacheTag.options.compress_backend = "zstd"
+        cache_tag = CacheTag.__new__(CacheTag)
+        data = b"".join(b"<li>item %d</li>" % (i * i % 97) for i in range(300))
+        for level in (None, 3, -1):
+            CacheTag.options.compress_level = level
+            compressed = cache_tag.compress(data)
+            assert compressed == compress_encoded(data, level, "zstd")
+            assert cache_tag.decompress(compressed) == data
+        assert compress_encoded(data, -1, "zstd") != compress_encoded(data, None, "zstd")
+
     @override_settings(
         ADV_CACHE_COMPRESS=True,
+        ADV_CACHE_COMPRESS_MIN_BYTES=0,
         ADV_CACHE_COMPRESS_SPACES=True,
     )
-    def test_full_compression(self):
+    @pytest.mark.parametrize("compress_backend", COMPRESS_BACKENDS)
+    def test_full_compression(self, compress_backend):
         """Test with ``ADV_CACHE_COMPRESS`` and ``ADV_CACHE_COMPRESS_SPACES`` set to ``True``."""
 
         # Reset CacheTag config with default value (from the ``override_settings``)
         self.reload_config()
+        CacheTag.options.compress_backend = compress_backend
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache, compressed
-        # We DON'T use ``SafeText`` as in ``test_compression`` because with was converted back
-        # to a real string when removing spaces
-        compressed = zlib.compress(pickle.dumps(" foobar "))
-        cache_expected = b"1::" + compressed
+        # Flagged as plain (``P``), not as safe as in ``test_compression``, because it was
+        # converted back to a real string when removing spaces
+        compressed = b"P" + compress_encoded(b" foobar\n", 1, compress_backend)
+        cache_expected = b"2::" + compressed
         assert caches["default"].get(key) == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
+    @override_settings(
+        ADV_CACHE_COMPRESS=True,
+    )
+    def test_compression_min_bytes(self):
+        """Test that contents smaller than ``ADV_CACHE_COMPRESS_MIN_BYTES`` are not compressed."""
+
+        # Reset CacheTag config with default value (from the ``override_settings``)
+        self.reload_config()
+
+        t = (
+            "{% load adv_cache %}{% cache 1 test_cached_template obj.pk obj.updated_at %}"
+            "  {{ obj.get_name }}{{ suffix }}  {% endcache %}"
+        )
+        key = self.get_template_key(
+            "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
+        )
+
+        # Render a first time, the content is too small to be compressed
+        assert self.render(t) == "foobar"
+        assert self.get_name_called == 1
+
+        # It should be in the cache, as is, flagged as safe but not compressed (``s``)
+        assert caches["default"].get(key) == b"2::s  foobar  "
+
+        # Render a second time, should hit the cache
+        assert self.render(t) == "foobar"
+        assert self.get_name_called == 1  # Still 1
+
+        # With a bigger content, it's compressed (``S``)
+        caches["default"].delete(key)
+        suffix = "x" * 50
+        assert self.render(t, {"suffix": suffix}) == "foobar" + suffix
+        assert self.get_name_called == 2  # One more
+        compressed = b"S" + compress_encoded(b"  foobar" + suffix.encode() + b"  ", 1, "zlib")
+        assert caches["default"].get(key) == b"2::" + compressed
+
+        # Render a second time, should hit the cache
+        assert self.render(t, {"suffix": suffix}) == "foobar" + suffix
+        assert self.get_name_called == 2  # Still 2
+
     @override_settings(
         ADV_CACHE_BACKEND="foo",
     )
@@ -521,25 +788,18 @@ class TestTag:
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key, "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key, "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n    foobar"
 
         # But not in the ``default`` cache
         assert caches["default"].get(key) is None
@@ -548,7 +808,7 @@ class TestTag:
         assert caches["foo"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_ADV_CACHE) == expected
         assert self.get_name_called == 1  # Still 1
 
     @override_settings(
@@ -574,7 +834,7 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
         assert self.get_foo_called == 1
 
@@ -582,18 +842,18 @@ class TestTag:
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache, with the RAW part
         cache_expected = (
-            b"1:: foobar {%endRAW_38a11088962625eb8c913e791931e2bc2e3c7228%} "
+            b"2:: foobar {%endRAW_38a11088962625eb8c913e791931e2bc2e3c7228%} "
             b"{{obj.get_foo}} {%RAW_38a11088962625eb8c913e791931e2bc2e3c7228%} !! "
         )
         assert caches["default"].get(key).strip() == cache_expected.strip()
 
         # Render a second time, should hit the cache but not for ``get_foo``
         expected = "foobar  foo 2  !!"
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
         assert self.get_foo_called == 2  # One more call to the non-cached part
 
@@ -616,17 +876,17 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # It should be in the cache, with the ``internal_version`` in the version
-        key = "template.cache_with_version.test_cache_with_version.a1d0c6e83f027327d8461063f4ac58a6"
-        cache_expected = b"1|v1::\n                foobar"
+        key = "template.cache_with_version.test_cache_with_version.755345b7ef54b0d592c17e04737ab3d9"
+        cache_expected = b"2|v1::\n                foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         self.get_name_called = 0
         # Calling it a new time should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 0
 
         # Changing the interval version should miss the cache
@@ -635,12 +895,12 @@ class TestTag:
         )
 
         InternalVersionTag.options.internal_version = "v2"
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # It should be in the cache, with the new ``internal_version`` in the version
-        key = "template.cache_with_version.test_cache_with_version.a1d0c6e83f027327d8461063f4ac58a6"
-        cache_expected = b"1|v2::\n                foobar"
+        key = "template.cache_with_version.test_cache_with_version.755345b7ef54b0d592c17e04737ab3d9"
+        cache_expected = b"2|v2::\n                foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
     def test_new_class(self):
@@ -660,7 +920,7 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t, {"multiplicator": 10}).strip() == expected
+        assert self.render(t, {"multiplicator": 10}) == expected
         assert self.get_name_called == 1
         assert self.get_foo_called == 1
 
@@ -670,11 +930,11 @@ class TestTag:
             vary_on=[self.obj["pk"], self.obj["updated_at"]],
             prefix="template.cache_test",
         )
-        assert key == "template.cache_test.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache_test.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache, with the RAW part
         cache_expected = (
-            b"1:: foobar {%endRAW_38a11088962625eb8c913e791931e2bc2e3c7228%} "
+            b"2:: foobar {%endRAW_38a11088962625eb8c913e791931e2bc2e3c7228%} "
             b"{{obj.get_foo}} {%RAW_38a11088962625eb8c913e791931e2bc2e3c7228%} !! "
         )
         assert caches["default"].get(key).strip() == cache_expected.strip()
@@ -688,7 +948,7 @@ class TestTag:
 
         # Render a second time, should hit the cache but not for ``get_foo``
         expected = "foobar  foo 2  !!"
-        assert self.render(t, {"multiplicator": 10}).strip() == expected
+        assert self.render(t, {"multiplicator": 10}) == expected
         assert self.get_name_called == 1  # Still 1
         assert self.get_foo_called == 2  # One more call to the non-cached part
 
@@ -711,24 +971,24 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t, {"fragment_name": "test_cached_template"}).strip() == expected
+        assert self.render(t, {"fragment_name": "test_cached_template"}) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # But it should NOT be the exact content as adv_cache_tag adds a version
         assert caches["default"].get(key).strip() != expected
 
         # It should be the version from `adv_cache_tag`
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n                foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t, {"fragment_name": "test_cached_template"}).strip() == expected
+        assert self.render(t, {"fragment_name": "test_cached_template"}) == expected
         assert self.get_name_called == 1  # Still 1
 
         # Using an undefined variable should fail
@@ -762,24 +1022,24 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # But it should NOT be the exact content as adv_cache_tag adds a version
         assert caches["default"].get(key).strip() != expected
 
         # It should be the version from `adv_cache_tag`
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n                foobar"
         assert caches["default"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
 
     def test_using_argument(self):
@@ -795,17 +1055,17 @@ class TestTag:
         """
 
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1
 
         # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template", vary_on=[self.obj["pk"], self.obj["updated_at"]]
         )
-        assert key == "template.cache.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == "template.cache.test_cached_template.82ea6d3ec173830f827f499fa1c7368f"
 
         # It should be in the cache
-        cache_expected = b"1::\n                foobar"
+        cache_expected = b"2::\n                foobar"
 
         # But not in the ``default`` cache
         assert caches["default"].get(key) is None
@@ -814,9 +1074,60 @@ class TestTag:
         assert caches["foo"].get(key).strip() == cache_expected
 
         # Render a second time, should hit the cache
-        assert self.render(t).strip() == expected
+        assert self.render(t) == expected
         assert self.get_name_called == 1  # Still 1
 
+    @pytest.mark.parametrize(
+        "timeout, condition, obj_pk, context_dict, use_cache",
+        [
+            ("1", "if obj.pk", 42, {}, True),
+            ("1", "if obj.pk", 0, {}, False),
+            ("1", "if undefined_var", 42, {}, False),
+            ("1", "unless no_cache", 42, {}, True),
+            ("1", "unless no_cache", 42, {"no_cache": True}, False),
+            # Arguments are still validated when the cache is not used
+            ("-1", "if obj.pk", 0, {}, False),
+        ],
+    )
+    def test_condition(self, monkeypatch, timeout, condition, obj_pk, context_dict, use_cache):
+        """Test the `if`/`unless` guard deciding if the cache backend is used."""
+
+        cache = caches["default"]
+        backend_calls = []
+        for method in ("get", "set"):
+            original = getattr(cache, method)
+            monkeypatch.setattr(
+                cache,
+                method,
+                lambda *args, _method=method, _original=original, **kwargs: (
+                    backend_calls.append(_method) or _original(*args, **kwargs)
+                ),
+            )
+
+        t = (
+            "{%% load adv_cache %%}"
+            "{%% cache %s test_cached_template obj.pk %s %%}{{ obj.get_name }}{%% endcache %%}"
+        ) % (timeout, condition)
+        context_dict = dict(context_dict, obj=dict(self.obj, pk=obj_pk))
+
+        if timeout == "-1":
+            with pytest.raises(template.TemplateSyntaxError) as raise_context:
+                self.render(t, context_dict)
+            assert "tag got a non-integer (or None) timeout value" in str(raise_context)
+            assert backend_calls == []
+            return
+
+        # Render two times, the second one should hit the cache only if it's used
+        assert self.render(t, context_dict) == "foobar"
+        assert self.render(t, context_dict) == "foobar"
+
+        if use_cache:
+            assert backend_calls == ["get", "set", "get"]
+            assert self.get_name_called == 1
+        else:
+            assert backend_calls == []
+            assert self.get_name_called == 2
+
     @override_settings(
         ADV_CACHE_COMPRESS_SPACES=True,
     )
@@ -828,101 +1139,94 @@ class TestTag:
 
         expected = "foobar FoOoO   FOO 1FOO 1 FoOoO  !!"
 
-        t = """
-            {% load adv_cache other_tags %}
-            {% cache 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }} {% insert_foo %}
-                {% nocache %}
-                    {% load other_filters %}
-                    {{ obj.get_foo|double_upper }} {% insert_foo %}
-                {% endnocache %}
-                !!
-            {% endcache %}
-        """
-
         # Render a first time, should miss the cache
-        assert self.render(t).strip() == expected
+        assert self.render(_T_NOCACHE_LIBS) == expected
         assert self.get_name_called == 1
         assert self.get_foo_called == 1
 
         # Render a second time, should hit the cache but not for ``get_foo``
         expected = "foobar FoOoO   FOO 2FOO 2 FoOoO  !!"
-        assert self.render(t).strip() == expected
+        assert self.render(_T_NOCACHE_LIBS) == expected
         assert self.get_name_called == 1  # Still 1
         assert self.get_foo_called == 2  # One more call to the non-cached part
 
+    @pytest.mark.parametrize(
+        "options, expected",
+        [
+            ({"OPTIONS": {"debug": True}}, True),
+            ({"OPTIONS": {"debug": False}}, False),
+            # Not following ``DEBUG`` (set to ``True`` below) when the option is not set
+            ({"OPTIONS": {}}, False),
+            ({}, False),
+        ],
+        ids=["debug-on", "debug-off", "no-debug-option", "no-options"],
+    )
+    def test_is_template_debug_activated(self, options, expected):
+        """Test that template debug is read from the ``TEMPLATES`` setting."""
+        templates = [
+            {"BACKEND": "django.template.backends.jinja2.Jinja2", "OPTIONS": {"debug": True}},
+            dict({"BACKEND": "django.template.backends.django.DjangoTemplates"}, **options),
+        ]
+        with override_settings(DEBUG=True, TEMPLATES=templates):
+            assert is_template_debug_activated() is expected
+
+    @contextmanager
     def set_template_debug_true(self):
-        templates_settings_copy = deepcopy(settings.TEMPLATES)
-        for template_settings in templates_settings_copy:
-            if template_settings["BACKEND"] == "django.template.backends.django.DjangoTemplates":
-                template_settings.setdefault("OPTIONS", {})["debug"] = True
-        return override_settings(TEMPLATES=templates_settings_copy)
-
-    def test_failure_when_setting_cache(self):
-        """Test that the template is correctly rendered even if the cache cannot be filled."""
+        """Activate template debug, without changing settings.
 
-        expected = "foobar"
-
-        t = """
-            {% load adv_cache_test %}
-            {% cache_set_fail 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache_set_fail %}
+        Overriding ``TEMPLATES`` would send ``setting_changed``, resetting all the engines and
+        their template loaders caches. So debug is set on the default engine, and
+        ``is_template_debug_activated`` (which reads the settings) is patched.
         """
-
-        # Render a first time, should still be rendered
-        assert self.render(t).strip() == expected
-
-        # Now the rendered template should NOT be in cache
-        key = self.get_template_key(
-            "test_cached_template",
-            vary_on=[self.obj["pk"], self.obj["updated_at"]],
-            prefix="template.cache_set_fail",
-        )
-        assert (
-            key == "template.cache_set_fail.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
-        )
-
-        # But not in the ``default`` cache
-        assert caches["default"].get(key) is None
-
-        # It should raise if templates debug mode is activated
-        with self.set_template_debug_true():
-            with pytest.raises(ValueError) as raise_context:
-                self.render(t)
-            assert "boom set" in str(raise_context)
-
-    def test_failure_when_getting_cache(self):
-        """Test that the template is correctly rendered even if the cache cannot be read."""
+        engine = Engine.get_default()
+        debug = engine.debug
+        engine.debug = True
+        # Templates compiled without debug cannot be rendered in debug mode
+        self._compiled_cache.clear()
+        try:
+            with pytest.MonkeyPatch.context() as monkeypatch:
+                monkeypatch.setattr("adv_cache_tag.tag.is_template_debug_activated", lambda: True)
+                yield
+        finally:
+            engine.debug = debug
+            self._compiled_cache.clear()
+
+    @pytest.mark.parametrize(
+        "template_text, nodename, cache_expected, error",
+        [
+            # The rendered template should NOT be in cache if it cannot be filled
+            (_T_CACHE_SET_FAIL, "cache_set_fail", None, "boom set"),
+            # But it should be in cache if only reading it fails
+            (_T_CACHE_GET_FAIL, "cache_get_fail", b"2::\n    foobar", "boom get"),
+        ],
+        ids=["setting", "getting"],
+    )
+    def test_failure_with_cache(self, template_text, nodename, cache_expected, error):
+        """Test that the template is correctly rendered even if the cache cannot be used."""
 
         expected = "foobar"
 
-        t = """
-            {% load adv_cache_test %}
-            {% cache_get_fail 1 test_cached_template obj.pk obj.updated_at %}
-                {{ obj.get_name }}
-            {% endcache_get_fail %}
-        """
-
         # Render a first time, should still be rendered
-        assert self.render(t).strip() == expected
+        assert self.render(template_text) == expected
 
-        # Now the rendered template should be in cache
         key = self.get_template_key(
             "test_cached_template",
             vary_on=[self.obj["pk"], self.obj["updated_at"]],
-            prefix="template.cache_get_fail",
+            prefix="template.%s" % nodename,
         )
-        assert (
-            key == "template.cache_get_fail.test_cached_template.0cac9a03d5330dd78ddc9a0c16f01403"
+        assert key == (
+            "template.%s.test_cached_template.82ea6d3ec173830f827f499fa1c7368f" % nodename
         )
 
-        # It should be in the cache
-        cache_expected = b"1::\n                foobar"
-        assert caches["default"].get(key).strip() == cache_expected
+        # Check what is in the ``default`` cache
+        cached = caches["default"].get(key)
+        if cache_expected is None:
+            assert cached is None
+        else:
+            assert cached.strip() == cache_expected
 
         # It should raise if templates debug mode is activated
         with self.set_template_debug_true():
             with pytest.raises(ValueError) as raise_context:
-                self.render(t)
-            assert "boom get" in str(raise_context)
+                self.render(template_text)
+            assert error in str(raise_context)
@@ -0,0 +1,53 @@
+import pickle
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+
+class RawLocMemCache(LocMemCache):
+    """Local memory cache keeping ``bytes`` values as is, without pickling them.
+
+    Other values are pickled, as in ``LocMemCache``. Raw values are stored in a 1-tuple to not
+    be confused with pickled ones, which are ``bytes`` too.
+    """
+
+    def _encode(self, value):
+        if type(value) is bytes:
+            return (value,)
+        return pickle.dumps(value, self.pickle_protocol)
+
+    @staticmethod
+    def _decode(stored):
+        if type(stored) is tuple:
+            return stored[0]
+        return pickle.loads(stored)
+
+    def _make_and_validate_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_and_validate_key(key, version=version)
+        stored = self._encode(value)
+        with self._lock:
+            if self._has_expired(key):
+                self._set(key, stored, timeout)
+                return True
+            return False
+
+    def get(self, key, default=None, version=None):
+        key = self._make_and_validate_key(key, version=version)
+        with self._lock:
+            if self._has_expired(key):
+                self._delete(key)
+                return default
+            stored = self._cache[key]
+            self._cache.move_to_end(key, last=False)
+        return self._decode(stored)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._make_and_validate_key(key, version=version)
+        stored = self._encode(value)
+        with self._lock:
+            self._set(key, stored, timeout)
@@ -1,27 +1,33 @@
 import os.path
-import zlib
 
 DEBUG = False
 
+# The caches are emptied around each test: a high MAX_ENTRIES makes sure no culling
+# happens during a test, and culling removes fewer entries if it ever happens
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "BACKEND": "adv_cache_tag.tests.testproject.cache.RawLocMemCache",
         "LOCATION": "default-cache",
+        "OPTIONS": {"MAX_ENTRIES": 10000, "CULL_FREQUENCY": 10},
     },
     "foo": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "BACKEND": "adv_cache_tag.tests.testproject.cache.RawLocMemCache",
         "LOCATION": "foo-cache",
+        "OPTIONS": {"MAX_ENTRIES": 10000, "CULL_FREQUENCY": 10},
     },
 }
 
 ADV_CACHE_VERSIONING = False
 ADV_CACHE_COMPRESS = False
-ADV_CACHE_COMPRESS_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+ADV_CACHE_COMPRESS_LEVEL = 1
+ADV_CACHE_COMPRESS_BACKEND = "zlib"
+ADV_CACHE_COMPRESS_MIN_BYTES = 50
 ADV_CACHE_COMPRESS_SPACES = False
 ADV_CACHE_INCLUDE_PK = False
 ADV_CACHE_BACKEND = "default"
 ADV_CACHE_VERSION = ""
 ADV_CACHE_RESOLVE_NAME = False
+ADV_CACHE_TAGS = ()
 
 SECRET_KEY = "m-92)2et+&&m5f&#jld7-_1qanq*n9!z90xc@+wx6y8d6y#w6t"
 
@@ -62,8 +68,18 @@ MIDDLEWARE_CLASSES = [
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
-        "APP_DIRS": True,
-        "OPTIONS": {"debug": False},
+        "OPTIONS": {
+            "debug": False,
+            "loaders": [
+                (
+                    "django.template.loaders.cached.Loader",
+                    [
+                        "django.template.loaders.filesystem.Loader",
+                        "django.template.loaders.app_directories.Loader",
+                    ],
+                ),
+            ],
+        },
     },
 ]
 